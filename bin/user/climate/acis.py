@@ -8,21 +8,99 @@ Instrument System (ACIS) servers into a local SQL database.
 
 See https://www.rcc-acis.org/docs_webservices.html for a description of the ACIS API.
 """
+import concurrent.futures
+import datetime
+import functools
+import gzip
+import hashlib
 import json
 import logging
+import sqlite3
+import threading
 import time
 import urllib.request
 
 import weedb
-import weewx.manager
-from weeutil.weeutil import to_int, to_float
-from user.climate.climate import default_binding_dict, setup_climate_database
+from weeutil.weeutil import to_float
+from user.climate.climate import check_table_name
+
+# orjson is much faster than the standard library at parsing the large, number-heavy responses
+# that ACIS returns. Use it if it is available.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# If ijson is available with its C backend, use it to parse responses directly off the socket.
+# This avoids holding the entire raw response in memory alongside the parsed result. The pure
+# Python backends are too slow to be worth it.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+else:
+    if ijson.backend != 'yajl2_c':
+        ijson = None
 
 log = logging.getLogger(__name__)
 
 ACIS_URL = "https://data.rcc-acis.org/StnData"
 ACIS_METADATA_URL = "https://data.rcc-acis.org/StnMeta"
 
+# How long to wait on the ACIS servers before giving up, in seconds
+HTTP_TIMEOUT = 30
+
+# ACIS is a free, public service. This is the most requests that will be made of it at once,
+# across all stations and elements being downloaded.
+MAX_CONCURRENT_REQUESTS = 4
+
+# Held while a request is outstanding.
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+
+if orjson:
+    def _loads(b):
+        """Parse JSON bytes into a Python object."""
+        return orjson.loads(b)
+
+    def _dumps(obj):
+        """Serialize a Python object into JSON bytes."""
+        return orjson.dumps(obj)
+else:
+    def _loads(b):
+        """Parse JSON bytes into a Python object."""
+        return json.loads(b.decode('utf-8'))
+
+    def _dumps(obj):
+        """Serialize a Python object into JSON bytes."""
+        return json.dumps(obj).encode('utf-8')
+
+# Map from the 'MM-DD' part of an ACIS date to a (month, day) tuple. Looking up the tuple is
+# faster than converting the two fields separately. Use a leap year, so that Feb 29 is included.
+_MONTH_DAY = {f'{d.month:02d}-{d.day:02d}': (d.month, d.day)
+              for d in (datetime.date(2000, 1, 1) + datetime.timedelta(days=i) for i in range(366))}
+
+
+def _parse(stream):
+    """Parse a JSON document from a file-like object."""
+    if ijson:
+        # Numbers are limited to station coordinates and elevations. The data values are strings.
+        return next(ijson.items(stream, '', use_float=True))
+    return _loads(stream.read())
+
+
+class _HashingReader:
+    """File-like wrapper that feeds everything read through it into a hashlib object."""
+
+    def __init__(self, stream, digest):
+        self.stream = stream
+        self.digest = digest
+
+    def read(self, size=None):
+        data = self.stream.read() if size is None or size < 0 else self.stream.read(size)
+        self.digest.update(data)
+        return data
+
 
 def acis_element(stat, reduce_method):
     """Return a dictionary representing an ACIS query element.
@@ -47,6 +125,20 @@ def acis_element(stat, reduce_method):
     }
 
 
+# The query elements are the same for every station, so build them once. Treat as read-only.
+ACIS_ELEMENTS = (
+    acis_element('maxt', 'mean'),
+    acis_element('maxt', 'max'),
+    acis_element('maxt', 'min'),
+    acis_element('mint', 'mean'),
+    acis_element('mint', 'max'),
+    acis_element('mint', 'min'),
+    acis_element('pcpn', 'max'),
+    acis_element('pcpn', 'min'),
+    acis_element('pcpn', 'mean'),
+)
+
+
 def acis_struct(station_id):
     """Return a dictionary representing an entire ACIS query structure."""
     return {
@@ -54,92 +146,305 @@ def acis_struct(station_id):
         'sdate': 'por',
         'edate': 'por',
         'meta': ['name', 'state'],
-        'elems': [
-            acis_element('maxt', 'mean'),
-            acis_element('maxt', 'max'),
-            acis_element('maxt', 'min'),
-            acis_element('mint', 'mean'),
-            acis_element('mint', 'max'),
-            acis_element('mint', 'min'),
-            acis_element('pcpn', 'max'),
-            acis_element('pcpn', 'min'),
-            acis_element('pcpn', 'mean'),
-        ]
+        'elems': ACIS_ELEMENTS,
     }
 
 
-def fetch_station_data(config_dict, station_id, current_date):
-    """Worker thread to fetch ACIS station metadata and historical data, then store
-     in the database."""
-
-    # Update both the station_metadata and the station_data tables as one transaction.
-    with weewx.manager.open_manager_with_config(
-            config_dict,
-            data_binding='climate_binding',
-            initialize=True,
-            default_binding_dict=default_binding_dict) as db_manager:
-        with weedb.Transaction(db_manager.connection) as cursor:
-            # First get the metadata for the station...
-            get_metadata(cursor, station_id)
-            # ...then the data itself:
-            get_data(cursor, station_id, db_manager.table_name, current_date)
+def fetch_station_data(db_manager, station_ids, current_date, shutdown_evt=None):
+    """Worker thread to fetch ACIS station metadata and historical data for a list of stations,
+     then store it in the database.
 
+    Args:
+        db_manager (StatsManager): An open manager for the climate database. It is owned by the
+            calling thread, which keeps it open from one download to the next.
+        station_ids (list[str]): The stations to download.
+        current_date (datetime.date): The date of the download.
+        shutdown_evt (threading.Event|None): Set when the engine is shutting down. The download
+            is then abandoned. Requests not yet made are cancelled, and nothing is stored.
+
+    Returns:
+        list[str]: The IDs of the stations whose data was downloaded and stored.
+    """
+    if shutdown_evt is None:
+        shutdown_evt = threading.Event()
+
+    # Do all the network I/O first, so the database is not locked while waiting on ACIS. All the
+    # requests, for the metadata and for the data of every station, share one pool of threads,
+    # so no more than MAX_CONCURRENT_REQUESTS are made at once.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS,
+                                               thread_name_prefix='climate-fetch') as executor:
+        meta_future = executor.submit(fetch_acis_metadata, station_ids)
+        data_list = fetch_acis_data(executor, station_ids, shutdown_evt)
+        if shutdown_evt.is_set():
+            meta_future.cancel()
+            log.info("Download of climate data for %s abandoned at shutdown.",
+                     ', '.join(station_ids))
+            return []
+        # A failure for one station must not keep the others from being stored.
+        try:
+            meta_rows = meta_future.result()
+        except Exception as e:
+            log.error("Could not fetch metadata for stations %s: %s",
+                      ', '.join(station_ids), e)
+            meta_rows = []
+
+    updated = [station_id for station_id, (results, data_hash) in zip(station_ids, data_list)
+               if results]
+    if not meta_rows and not updated:
+        return []
 
-def get_metadata(cursor, station_id):
-    """Insert metadata about the given station into the database. """
+    # Update both the station_metadata and the station_data tables as one transaction.
+    with weedb.Transaction(db_manager.connection) as cursor:
+        # First the metadata for all the stations...
+        write_metadata(cursor, meta_rows)
+        # ...then the data itself:
+        for station_id, (results, data_hash) in zip(station_ids, data_list):
+            write_data(cursor, station_id, db_manager.table_name, current_date,
+                       results, data_hash)
+    return updated
+
+
+def fetch_acis_metadata(station_ids):
+    """Fetch metadata about the given stations. ACIS accepts a list of stations, so the metadata
+    for all of them is fetched with a single request.
+
+    Returns:
+        list[tuple]: A row for the station_metadata table for each station that was found.
+    """
 
     # Construct JSON payload:
-    payload = json.loads('{"sids":"%s"}' % station_id)
+    payload = {'sids': ','.join(station_ids),
+               'meta': ['name', 'state', 'll', 'elev', 'sids']}
     results = do_fetch(payload, ACIS_METADATA_URL)
 
-    if not results:
+    if not _is_valid(results, 'meta'):
+        return []
+
+    # ACIS returns the stations in no particular order, so match them up using their IDs. Each ID
+    # is returned in the form 'USC00040983 6', where the last digit is the type of ID.
+    meta_list = results['meta']
+    if len(station_ids) == 1 and len(meta_list) == 1:
+        by_id = {station_ids[0]: meta_list[0]}
+    else:
+        by_id = {sid.split()[0]: data for data in meta_list for sid in data.get('sids', [])}
+
+    rows = []
+    for station_id in station_ids:
+        data = by_id.get(station_id)
+        if data is None:
+            log.warning("No metadata returned for station %s.", station_id)
+            continue
+        try:
+            rows.append((station_id,
+                         data['name'],
+                         data['state'],
+                         to_float(data['ll'][1]),
+                         to_float(data['ll'][0]),
+                         to_float(data.get('elev')),
+                         'foot'))
+        except (KeyError, IndexError, TypeError) as e:
+            log.warning("Incomplete metadata returned for station %s: %s", station_id, e)
+    return rows
+
+
+# UPSERT (INSERT ... ON CONFLICT DO UPDATE) first appeared in SQLite 3.24. Older versions get
+# equivalent, if slower, statements.
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Insert metadata into the station_metadata table. If the station is already there, keep its
+# download date and data hash.
+UPSERT_METADATA = "INSERT INTO station_metadata (station_id, station_name, station_location, " \
+                  "latitude, longitude, altitude, altitude_unit) " \
+                  "VALUES (?, ?, ?, ?, ?, ?, ?) " \
+                  "ON CONFLICT(station_id) DO UPDATE SET " \
+                  "station_name = excluded.station_name, " \
+                  "station_location = excluded.station_location, " \
+                  "latitude = excluded.latitude, " \
+                  "longitude = excluded.longitude, " \
+                  "altitude = excluded.altitude, " \
+                  "altitude_unit = excluded.altitude_unit;"
+
+# Without UPSERT, update any existing rows, then insert the rest. INSERT OR REPLACE is no good
+# here: it would delete the download date and data hash along with the old row.
+UPDATE_METADATA = "UPDATE station_metadata SET station_name = ?, station_location = ?, " \
+                  "latitude = ?, longitude = ?, altitude = ?, altitude_unit = ? " \
+                  "WHERE station_id = ?;"
+INSERT_NEW_METADATA = "INSERT OR IGNORE INTO station_metadata (station_id, station_name, " \
+                      "station_location, latitude, longitude, altitude, altitude_unit) " \
+                      "VALUES (?, ?, ?, ?, ?, ?, ?);"
+
+
+@functools.lru_cache(maxsize=None)
+def data_statements(table_name):
+    """Return the SQL statements used by write_data() for a given climate table. They are built,
+    and the table name validated, only once per table. Passing sqlite3 the identical statement
+    strings each time also keeps its prepared statement cache warm."""
+    check_table_name(table_name)
+    return {
+        'select_hash': "SELECT data_hash FROM station_metadata WHERE station_id = ?;",
+        # The records have 9 elements. Match the 9 columns in CREATE_CLIMATE_DATA. If a record is
+        # already in the database, update it in place.
+        # Without UPSERT, INSERT OR REPLACE has the same effect, since every column is given.
+        'upsert': "INSERT INTO " + table_name + " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                  "ON CONFLICT(station_id, month, day, obsType, stat, reduction) DO UPDATE SET "
+                  "usUnits = excluded.usUnits, value = excluded.value, year = excluded.year;"
+        if HAS_UPSERT else
+        "INSERT OR REPLACE INTO " + table_name + " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        'update': "UPDATE station_metadata SET last_download = ?, data_hash = ? "
+                  "WHERE station_id = ?;",
+    }
+
+
+def write_metadata(cursor, meta_rows):
+    """Insert station metadata, as returned by fetch_acis_metadata(), into the database."""
+    if not meta_rows:
         return
+    if HAS_UPSERT:
+        cursor.executemany(UPSERT_METADATA, meta_rows)
+    else:
+        cursor.executemany(UPDATE_METADATA, [row[1:] + row[:1] for row in meta_rows])
+        cursor.executemany(INSERT_NEW_METADATA, meta_rows)
+    log.debug("Metadata for %d station(s) inserted into database.", len(meta_rows))
 
-    data = results['meta'][0]
-    meta = {'station_id': station_id,
-            'station_name': data['name'],
-            'station_location': data['state'],
-            'latitude': data['ll'][1],
-            'longitude': data['ll'][0],
-            'altitude': data['elev'],
-            'altitude_unit': 'foot',
-            'last_download': None,
-            }
-    # Insert it into the station_metadata table
-    cursor.execute("INSERT OR REPLACE INTO station_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
-                   (meta['station_id'],
-                    meta['station_name'],
-                    meta['station_location'],
-                    meta['latitude'],
-                    meta['longitude'],
-                    meta['altitude'],
-                    meta['altitude_unit'],
-                    meta['last_download']))
-    log.debug(f"Metadata for station {station_id} inserted into database.")
-
-
-def get_data(cursor, station_id, table_name, current_date):
-    """Get the historical data for the given station and store it in the database."""
-
-    # Construct JSON query payload:
-    payload = acis_struct(station_id)
-    # Do the fetch, then look for results:
-    results = do_fetch(payload, ACIS_URL)
+
+def write_data(cursor, station_id, table_name, current_date, results, data_hash):
+    """Store the historical data for the given station, as returned by fetch_acis_data(), in
+    the database."""
     if not results:
         return
 
-    # 1. Clear entries for this station ID
-    cursor.execute(f"DELETE FROM %s WHERE station_id = ?;" % table_name, (station_id,))
+    stmts = data_statements(table_name)
 
-    # 2. Now batch insert the new data.
-    for rec in gen_acis_records(results, station_id):
-        # The record has 9 elements. Match the 9 columns in CREATE_CLIMATE_DATA
-        cursor.execute(f"INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);" % table_name, rec)
+    # If ACIS has not changed anything since the last download, there is no need to replace the
+    # data. Just record the download.
+    cursor.execute(stmts['select_hash'], (station_id,))
+    row = cursor.fetchone()
+    if row and row[0] == data_hash:
+        cursor.execute(stmts['update'], (current_date.isoformat(), data_hash, station_id))
+        log.debug("Climate data for station %s is unchanged.", station_id)
+        return
 
-    # 3. Update the download date in the station metadata table.
-    cursor.execute(f"UPDATE station_metadata SET last_download = ? WHERE station_id = ?;",
-                   (current_date.isoformat(), station_id))
-    log.debug(f"Climate data for station {station_id} inserted into database.")
+    # 1. Batch insert or update the new data. Function gen_acis_records() is a generator, so the
+    # records are streamed into the database without materializing them all.
+    cursor.executemany(stmts['upsert'], gen_acis_records(results, station_id))
+
+    # 2. Update the download date and data hash in the station metadata table.
+    cursor.execute(stmts['update'], (current_date.isoformat(), data_hash, station_id))
+    log.debug("Climate data for station %s inserted into database.", station_id)
+
+
+def fetch_acis_data(executor, station_ids, shutdown_evt):
+    """Fetch the summary data for the given stations from ACIS.
+
+    Each element is a long, independent query, so they are requested separately, and in
+    parallel, using the given executor. The results for each station are then merged back
+    together, in the order given by acis_struct(), into the structure that a single query would
+    have returned. The first element of each station is fetched on its own, so a station that
+    ACIS cannot serve, or an ACIS outage, costs one request rather than one per element. After
+    that, if one request for a station fails, its requests not yet made are skipped. If
+    shutdown_evt gets set, all the requests not yet made are cancelled.
+
+    Returns:
+        list[tuple]: For each station, the merged results and a hash of the raw data.
+            (None, None) if any fetch for the station failed.
+    """
+    downloads = [_StationDownload(station_id, shutdown_evt) for station_id in station_ids]
+
+    # Key is a future, value is the station download it belongs to.
+    first = {executor.submit(download.fetch_element, 0): download for download in downloads}
+    rest = {}
+    for future in concurrent.futures.as_completed(first):
+        download = first[future]
+        if shutdown_evt.is_set():
+            _cancel(first)
+        elif _succeeded(future, download):
+            rest.update((executor.submit(download.fetch_element, i), download)
+                        for i in range(1, len(download.payloads)))
+    for future in concurrent.futures.as_completed(rest):
+        if shutdown_evt.is_set():
+            _cancel(rest)
+        else:
+            _succeeded(future, rest[future])
+    if shutdown_evt.is_set():
+        return [(None, None)] * len(downloads)
+
+    data_list = []
+    for download in downloads:
+        try:
+            data_list.append(download.merged())
+        except (KeyError, IndexError, TypeError) as e:
+            log.error("Malformed climate data returned for station %s: %s",
+                      download.station_id, e)
+            data_list.append((None, None))
+    return data_list
+
+
+def _cancel(futures):
+    """Cancel the futures that have not started running yet."""
+    for future in futures:
+        future.cancel()
+
+
+def _succeeded(future, download):
+    """Return True if a request made by fetch_acis_data() succeeded. If it raised an exception,
+    log it and mark the station as failed."""
+    try:
+        future.result()
+    except Exception as e:
+        log.error("Could not fetch climate data for station %s: %s", download.station_id, e)
+        download.failed.set()
+    return not download.failed.is_set()
+
+
+class _StationDownload:
+    """The element requests for one station, and the results that come back from them."""
+
+    def __init__(self, station_id, shutdown_evt):
+        self.station_id = station_id
+        self.shutdown_evt = shutdown_evt
+        # Construct JSON query payload, then split it into one payload per element:
+        payload = acis_struct(station_id)
+        self.payloads = [dict(payload, elems=[elem]) for elem in payload['elems']]
+        # Each fetch gets its own hash of the raw response, so they can be combined in a known
+        # order.
+        self.digests = [hashlib.blake2b(digest_size=16) for _ in self.payloads]
+        self.results = [None] * len(self.payloads)
+        self.failed = threading.Event()
+
+    def fetch_element(self, i):
+        """Fetch the i'th element, unless an earlier request for the station has failed, or
+        the engine is shutting down."""
+        if self.failed.is_set() or self.shutdown_evt.is_set():
+            return
+        results = do_fetch(self.payloads[i], ACIS_URL, self.digests[i])
+        # ACIS returns an error, rather than data, for a bad request such as an unknown station.
+        if not _is_valid(results, 'meta', 'smry'):
+            self.failed.set()
+            return
+        self.results[i] = results
+
+    def merged(self):
+        """Return the merged results, and a hash of the raw data. (None, None) if any fetch
+        failed."""
+        if self.failed.is_set():
+            log.error("No usable climate data returned for station %s.", self.station_id)
+            return None, None
+
+        data_hash = hashlib.blake2b(b''.join(d.digest() for d in self.digests), digest_size=16)
+        return ({'meta': self.results[0]['meta'],
+                 'smry': [results['smry'][0] for results in self.results]},
+                data_hash.hexdigest())
+
+
+def _is_valid(results, *keys):
+    """Return True if an ACIS response holds all the given keys. For a bad request, such as an
+    unknown station, ACIS returns a dictionary with key 'error' instead."""
+    if not isinstance(results, dict):
+        return False
+    if 'error' in results:
+        log.error("ACIS returned error: %s", results['error'])
+        return False
+    return all(key in results for key in keys)
 
 
 def gen_acis_records(results, station_id):
@@ -181,49 +486,71 @@ def gen_acis_records(results, station_id):
                 ('low', 'avg', 'outTemp'), ('low', 'max', 'outTemp'), ('low', 'min', 'outTemp'),
                 ('sum', 'max', 'precip'), ('sum', 'min', 'precip'), ('sum', 'avg', 'precip')]
 
-    # Scan through the 6 different statistics and reduction methods returned from the server
-    for stat_tuple, element_list in zip(ordering, results['smry']):
-        stat, reduction, obs_type = stat_tuple
+    # In this version, everything is in US units.
+    usUnits = 1
+    # Local names are faster to look up than globals or builtins in the loop below.
+    _float = float
+    _int = int
+    month_day = _MONTH_DAY
+
+    # Scan through the 9 different statistics and reduction methods returned from the server
+    for (stat, reduction, obs_type), element_list in zip(ordering, results['smry']):
+        # There is no record year for reduction methods of 'avg':
+        is_avg = reduction == 'avg'
         for day_tuple in element_list:
             # Put the following in a try block in case of malformed data
             try:
                 # The value is in the first element. It's a string, so convert it to a float. Watch
-                # out for missing values (marked with 'M') and "trace" (marked with 'T'):
-                val = day_tuple[0].strip().upper()
-                if val == 'M':
+                # out for missing values (marked with 'M') and "trace" (marked with 'T'). Checking
+                # only the first character avoids allocating stripped or upper-cased copies.
+                val = day_tuple[0]
+                code = val[:1]
+                if code in ('M', 'm'):
                     value = None
-                elif val == 'T':
+                elif code in ('T', 't'):
                     value = 0.0
                 else:
-                    value = to_float(day_tuple[0])
+                    value = _float(val)
                 # The second element holds the date in the form 'YYYY-MM-DD'.
-                year, month, day = [to_int(e) for e in day_tuple[1].split('-')]
-            except ValueError:
+                date = day_tuple[1]
+                year = None if is_avg else _int(date[:4])
+                month, day = month_day[date[5:10]]
+            except (ValueError, KeyError):
                 continue
-            # There is no record year for reduction methods of 'avg':
-            if reduction == 'avg':
-                year = None
-            # In this version, everything is in US units.
-            usUnits = 1
             yield (station_id, month, day, usUnits, obs_type,
                    stat, reduction, value, year)
 
 
-def do_fetch(payload, url):
-    """Generic fetch"""
+def do_fetch(payload, url, digest=None):
+    """Generic fetch. If a hashlib object is given in digest, it is updated with the raw
+    response."""
     try:
+        # The JSON compresses well, so ask for it compressed.
         request = urllib.request.Request(
             url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
+            data=_dumps(payload),
+            headers={'Content-Type': 'application/json',
+                     'Accept-Encoding': 'gzip'}
         )
-        start = time.time()
-        with urllib.request.urlopen(request) as response:
-            results = json.loads(response.read().decode('utf-8'))
+        with _request_slots:
+            start = time.time()
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+                results = _read_response(response, digest)
     except Exception as e:
-        log.error(f"Error fetching JSON data from URL {url}: {e}")
+        log.error("Error fetching JSON data from URL %s: %s", url, e)
         return None
     else:
         stop = time.time()
-        log.debug(f"Fetched JSON data from {url} in {stop - start:.2f} seconds")
+        log.debug("Fetched JSON data from %s in %.2f seconds", url, stop - start)
         return results
+
+
+def _read_response(response, digest=None):
+    """Parse the JSON in an HTTP response, decompressing it as it arrives."""
+    stream = response
+    if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+        stream = gzip.GzipFile(fileobj=response)
+    # Hash the decompressed data, so the hash does not depend on how the server compressed it.
+    if digest:
+        stream = _HashingReader(stream, digest)
+    return _parse(stream)
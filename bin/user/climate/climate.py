@@ -5,8 +5,12 @@
 #
 """Create and manage a climatological database for WeeWX."""
 import datetime
+import functools
 import importlib
 import logging
+import queue
+import re
+import sys
 import threading
 import time
 
@@ -17,26 +21,50 @@ import weewx.xtypes
 from weeutil.weeutil import to_bool, to_int
 from weewx.engine import StdService
 
-# import user.climate.clxtype
+import user.climate.clxtype
 
-VERSION = '1.2'
+VERSION = '1.4'
 
 log = logging.getLogger(__name__)
 
-CREATE_CLIMATE_DATA = "CREATE TABLE %s " \
+CREATE_CLIMATE_DATA = "CREATE TABLE IF NOT EXISTS %s " \
                       "(station_id TEXT NOT NULL, month INTEGER NOT NULL, day INTEGER NOT NULL, " \
                       "usUnits INTEGER NOT NULL, obsType TEXT NOT NULL, stat TEXT NOT NULL, " \
                       "reduction TEXT NOT NULL, value REAL, year INTEGER);"
 
-CREATE_CLIMATE_INDEX = "CREATE INDEX %s_index ON climate_data (station_id, month, day);"
+# Each record is uniquely identified by its station, day, and statistic. This lets downloads
+# update records in place.
+CREATE_CLIMATE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS %s_key " \
+                       "ON %s (station_id, month, day, obsType, stat, reduction);"
 
-CREATE_STATION_METADATA = "CREATE TABLE station_metadata " \
+# The same key, followed by the columns that lookups return. Lookups can then be answered from
+# the index alone, without also reading the table. The unique index is still needed, because
+# an upsert's conflict target must match a unique index exactly.
+CREATE_CLIMATE_COVERING_INDEX = "CREATE INDEX IF NOT EXISTS %s_covering " \
+                                "ON %s (station_id, month, day, obsType, stat, reduction, " \
+                                "usUnits, value, year);"
+
+CREATE_STATION_METADATA = "CREATE TABLE IF NOT EXISTS station_metadata " \
                           "(station_id TEXT PRIMARY KEY, " \
                           "station_name TEXT, " \
                           "station_location TEXT, " \
                           "latitude REAL, longitude REAL, " \
                           "altitude REAL, altitude_unit TEXT, " \
-                          "last_download TEXT);"
+                          "last_download TEXT, " \
+                          "data_hash TEXT);"
+
+# SQLite tuning for the climate database. The write-ahead log turns the commit at the end of a
+# download from an fsync of both the rollback journal and the database into an append, and lets
+# report generation read while the worker thread writes. The journal mode is stored in the
+# database; the others must be set on every connection. The busy timeout comes first, because
+# setting the journal mode needs a lock that the worker thread may be holding.
+SQLITE_PRAGMAS = (
+    ('busy_timeout', '5000'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', '-20000'),
+)
 
 default_binding_dict = {
     'database': 'climate_sqlite',
@@ -46,6 +74,20 @@ default_binding_dict = {
 
 default_station_id = None
 
+# The registered climate XType, and how many services are using it.
+_xtype = None
+_xtype_users = 0
+_xtype_lock = threading.Lock()
+
+# Table names get interpolated into SQL statements, so they must be plain identifiers.
+valid_table_name = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def check_table_name(table_name):
+    """Raise ValueError if table_name is not safe to interpolate into SQL."""
+    if not valid_table_name.fullmatch(table_name):
+        raise ValueError(f"Invalid table name '{table_name}'")
+
 
 class StatsManager(weewx.manager.Manager):
     """Specialized manager for the climate database. The base class manager is designed to
@@ -54,15 +96,51 @@ class StatsManager(weewx.manager.Manager):
     @classmethod
     def open_with_create(cls, database_dict, table_name, schema=None):
         """Overrides base class method because we use a different kind of schema. """
-        setup_climate_database(database_dict, table_name)
-        connection = weedb.connect(database_dict)
+        try:
+            connection = weedb.connect(database_dict)
+        except weedb.NoDatabaseError:
+            weedb.create(database_dict)
+            log.debug("Climate database created.")
+            connection = weedb.connect(database_dict)
+        apply_pragmas(connection)
+        setup_climate_database(connection, table_name)
+        upgrade_climate_database(connection, table_name)
         # Create an instance of the right class and return it:
         dbmanager = cls(connection, table_name=table_name, schema=None)
         return dbmanager
 
+    @classmethod
+    def open(cls, database_dict, table_name='climate_data'):
+        """Overrides base class method, so that connections opened without initialization,
+        such as those used for reports, get the same tuning as the rest."""
+        connection = weedb.connect(database_dict)
+        apply_pragmas(connection)
+        return cls(connection, table_name=table_name)
+
     def __init__(self, connection, table_name, schema=None):
+        check_table_name(table_name)
         self.connection = connection
         self.table_name = table_name
+        self.normals_sql = normals_statement(table_name)
+
+    def get_normals(self, station_id, month, day):
+        """Return all the climate statistics for a station and day of the year.
+
+        Args:
+            station_id (str): The station.
+            month (int): The month, 1-12.
+            day (int): The day of the month.
+
+        Returns:
+            dict: Key is a tuple (obsType, stat, reduction), value is a tuple (value, usUnits,
+                year).
+        """
+        # The keys are interned, so that looking them up with the names that come from template
+        # tags can usually be settled by comparing pointers.
+        return {(sys.intern(obs_type), sys.intern(stat), sys.intern(reduction)):
+                    (value, us_units, year)
+                for obs_type, stat, reduction, value, us_units, year
+                in self.genSql(self.normals_sql, (station_id, month, day))}
 
 
 class Climate(StdService):
@@ -71,6 +149,18 @@ class Climate(StdService):
         # Initialize my base class:
         super().__init__(engine, config_dict)
 
+        # The stations, the queue of pending downloads, and the registered XType. They stay
+        # empty if the extension is disabled.
+        self.stations = {}
+        self.jobs = None
+        self.xt = None
+        # The most recent date for which all stations were found to be current.
+        self._last_checked_date = None
+        # Guards the per-station state, which the worker thread updates as downloads finish.
+        self._state_lock = threading.RLock()
+        # Set when the engine shuts down. Downloads still in the queue are then abandoned.
+        self._shutdown_evt = threading.Event()
+
         # Extract our configuration stanza out of the main configuration dictionary:
         try:
             climate_dict = config_dict['Climate']
@@ -82,122 +172,270 @@ class Climate(StdService):
             log.info("weewx-climate extension is disabled.")
             return
 
-        # How long to wait before launching a new thread if one is already running:
-        self.max_wait = to_int(climate_dict.get('max_wait', 600))
+        # Register the XType before anything that could fail, so shutDown() always has it to
+        # remove. If the service is created more than once, the instances share one XType.
+        self.xt = register_xtype()
 
-        self.stations = {}
+        # How long a download may be pending before it is reported as stalled:
+        self.max_wait = to_int(climate_dict.get('max_wait', 600))
 
         # Iterate through the stations
         for station_id in climate_dict.sections:
-            log.debug(f"Processing station: {station_id}")
+            log.debug("Processing station: %s", station_id)
             # Get the downloader name for this station, then import it.
             try:
-                downloader = importlib.import_module(climate_dict[station_id]['downloader'])
+                downloader = load_downloader(climate_dict[station_id]['downloader'])
             except (ImportError, KeyError):
-                log.error(f"Missing downloader for station {station_id}. Skipped.")
+                log.error("Missing downloader for station %s. Skipped.", station_id)
                 continue
 
             # Stuff to remember:
             self.stations[station_id] = {
-                'thread': None,
                 'launch_time': None,
                 'downloader': downloader,
+                'last_download': None,
             }
 
-            with weewx.manager.open_manager_with_config(
-                    config_dict,
-                    data_binding='climate_binding',
-                    initialize=True,
-                    default_binding_dict=default_binding_dict) as db_manager:
-
-                # Fetch initial data for this station
-                self.fetch_data(db_manager, station_id, datetime.date.today())
-
-                # Set the default station ID to the first station
-                global default_station_id
-                if not default_station_id:
-                    default_station_id = station_id
-
-        # Register the XType
-        # self.xt = user.climate.clxtype.ClimateXType()
-        # weewx.xtypes.xtypes.append(self.xt)
+            # Set the default station ID to the first station
+            global default_station_id
+            if not default_station_id:
+                default_station_id = station_id
+
+        with open_climate_manager(config_dict) as db_manager:
+            # Find when each station was last downloaded, with one query for all the stations.
+            # After this, the dates are kept in memory, so the database does not have to be
+            # consulted on every archive record.
+            if self.stations:
+                placeholders = ', '.join('?' * len(self.stations))
+                for station_id, last_download in db_manager.genSql(
+                        "SELECT station_id, last_download "
+                        "FROM station_metadata "
+                        f"WHERE station_id IN ({placeholders});", tuple(self.stations)):
+                    if last_download:
+                        # Keep the date as an ordinal, which is cheaper to compare.
+                        self.stations[station_id]['last_download'] = \
+                            datetime.date.fromisoformat(last_download).toordinal()
+
+        # All downloads are done by a single, long-lived worker thread. Don't prevent the
+        # program from exiting on its account.
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self.run_jobs, name='climate-downloader')
+        self.worker.daemon = True
+        self.worker.start()
+
+        # Fetch initial data for all stations
+        self.fetch_data(datetime.date.today())
 
         self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
     def new_archive_record(self, event):
         """Called when a new archive record is generated. Check to see if it's time for a new
-        download of ACIS data. If so, launch a thread to do it."""
+        download of ACIS data. If so, queue it for the worker thread."""
 
         # Get the date from the current record:
         current_date = datetime.datetime.fromtimestamp(event.record['dateTime']).date()
 
-        for station_id in self.stations:
-            with weewx.manager.open_manager_with_config(
-                    self.config_dict,
-                    data_binding='climate_binding',
-                    initialize=True,
-                    default_binding_dict=default_binding_dict) as db_manager:
-                # Update data if necessary.
-                self.fetch_data(db_manager, station_id, current_date)
-
-    def fetch_data(self, db_manager, station_id, current_date):
-        """If the data is not current, launch a thread to download it."""
-
-        # Determine the last download time.
-        results = db_manager.getSql("SELECT last_download "
-                                    "FROM station_metadata "
-                                    "WHERE station_id = ?;", (station_id,))
-        download_date = results[0] if results else None
-        if download_date and download_date >= current_date.isoformat():
-            log.debug("Climate data is current.")
-            return
+        # Update data if necessary.
+        self.fetch_data(current_date)
 
-        log.debug("Climate data is not current. Updating...")
+    def fetch_data(self, current_date):
+        """Find the stations whose data is not current, then queue downloads for them.
+        Stations that share a downloader are downloaded together, as a single job."""
 
-        # Do not launch the update thread if an old one is still alive.
-        # To guard against a zombie thread (alive, but doing nothing) launch
-        # anyway if enough time has passed.
-        if self.stations[station_id]['thread'] and self.stations[station_id]['thread'].is_alive():
-            thread_age = time.time() - self.stations[station_id]['launch_time']
-            if thread_age < self.max_wait:
-                log.info("Launch of download thread aborted: existing thread is still running")
-                return
-            else:
-                log.warning("Previous download thread has been running %s seconds. "
-                            "Launching a new thread anyway.", thread_age)
+        # Downloads only ever bring a station up to date, so once every station has been found
+        # current for a date, there is nothing more to check until the date changes.
+        if current_date == self._last_checked_date:
+            return
 
+        with self._state_lock:
+            # Key is a downloader, value is the list of stations it needs to download.
+            stale_stations = {}
+            all_current = True
+
+            current_ordinal = current_date.toordinal()
+
+            for station_id, station in self.stations.items():
+                # Determine the last download time.
+                download_date = station['last_download']
+                if download_date and download_date >= current_ordinal:
+                    log.debug("Climate data for station %s is current.", station_id)
+                    continue
+
+                log.debug("Climate data for station %s is not current. Updating...", station_id)
+                all_current = False
+
+                # Do not queue another download if one is still pending. There is only one
+                # worker thread, so a new job would just wait behind a download that has hung.
+                # Report the stall instead.
+                if station['launch_time']:
+                    job_age = time.time() - station['launch_time']
+                    if job_age < self.max_wait:
+                        log.info("Download of station %s aborted: previous download still pending",
+                                 station_id)
+                    else:
+                        log.warning("Download of station %s has been pending %.0f seconds. "
+                                    "It may have stalled.", station_id, job_age)
+                    continue
+
+                stale_stations.setdefault(station['downloader'], []).append(station_id)
+
+            if all_current:
+                self._last_checked_date = current_date
+
+            launch_time = time.time()
+            for downloader, station_ids in stale_stations.items():
+                for station_id in station_ids:
+                    self.stations[station_id]['launch_time'] = launch_time
+                self.jobs.put((downloader, station_ids, current_date))
+
+    def run_jobs(self):
+        """Body of the worker thread. Runs queued downloads, one after another, until it
+        receives None or the engine shuts down."""
+        # The worker keeps one connection to the climate database open for its whole life,
+        # rather than opening one per download. SQLite connections cannot be shared between
+        # threads, so it is opened here, in the worker thread.
+        db_manager = None
         try:
-            self.stations[station_id]['thread'] = threading.Thread(
-                target=self.stations[station_id]['downloader'].fetch_station_data,
-                args=(self.config_dict, station_id, current_date))
-            # Don't prevent the program from exiting on my account:
-            self.stations[station_id]['thread'].daemon = True
-            self.stations[station_id]['thread'].start()
-            self.stations[station_id]['launch_time'] = time.time()
-        except threading.ThreadError:
-            log.error("Unable to launch update thread.")
-            self.stations[station_id]['thread'] = None
+            while True:
+                job = self.jobs.get()
+                if job is None or self._shutdown_evt.is_set():
+                    return
+                downloader, station_ids, current_date = job
+                try:
+                    if db_manager is None:
+                        db_manager = open_climate_manager(self.config_dict)
+                    self.download(db_manager, downloader, station_ids, current_date)
+                except Exception as e:
+                    log.error("Download of climate data for %s failed: %s",
+                              ', '.join(station_ids), e)
+                    # Start over with a fresh connection for the next download.
+                    if db_manager:
+                        db_manager.close()
+                        db_manager = None
+                finally:
+                    with self._state_lock:
+                        for station_id in station_ids:
+                            self.stations[station_id]['launch_time'] = None
+        finally:
+            if db_manager:
+                db_manager.close()
+
+    def download(self, db_manager, downloader, station_ids, current_date):
+        """Run a downloader, then remember which stations it brought up to date."""
+        updated = downloader.fetch_station_data(db_manager, station_ids, current_date,
+                                                self._shutdown_evt)
+        with self._state_lock:
+            for station_id in updated or []:
+                self.stations[station_id]['last_download'] = current_date.toordinal()
+        # Statistics the XType has cached may now be out of date.
+        xt = self.xt
+        if updated and xt:
+            xt.clear_cache()
 
     def shutDown(self):
-        # Engine is shutting down. Remove the XType registration
-        weewx.xtypes.xtypes.remove(self.xt)
-
-
-def setup_climate_database(database_dict, table_name):
-    try:
-        # This will raise exception weedb.DatabaseExistsError if the database already exists.
-        weedb.create(database_dict)
-        log.debug("Climate database created.")
-    except weedb.DatabaseExistsError:
-        log.debug("Climate database already exists.")
+        # Engine is shutting down. Stop the worker thread once it has finished what it is doing.
+        self._shutdown_evt.set()
+        if self.jobs:
+            self.jobs.put(None)
+        # The cached download dates are only good while the service is running.
+        with self._state_lock:
+            for station in self.stations.values():
+                station['last_download'] = None
+            self._last_checked_date = None
+        # Remove the XType registration
+        if self.xt:
+            unregister_xtype()
+            self.xt = None
+
+
+def register_xtype():
+    """Register the climate XType with WeeWX, unless an earlier service already has. Returns the
+    registered instance. Each call must be matched by a call to unregister_xtype()."""
+    global _xtype, _xtype_users
+    with _xtype_lock:
+        if not _xtype_users:
+            _xtype = user.climate.clxtype.ClimateXType()
+            weewx.xtypes.xtypes.append(_xtype)
+        _xtype_users += 1
+        return _xtype
+
+
+def unregister_xtype():
+    """Release a registration made by register_xtype(). The XType is removed from WeeWX once
+    the last service using it is done with it."""
+    global _xtype, _xtype_users
+    with _xtype_lock:
+        _xtype_users -= 1
+        if not _xtype_users:
+            if _xtype in weewx.xtypes.xtypes:
+                weewx.xtypes.xtypes.remove(_xtype)
+            _xtype = None
+
+
+@functools.lru_cache(maxsize=None)
+def normals_statement(table_name):
+    """Return the query used by StatsManager.get_normals() for a given climate table. Managers
+    are opened anew for every report, so caching it means each one passes sqlite3 the very same
+    string, and it is formatted only once. Every column it uses is in the covering index, so it
+    is answered without reading the table. Keep the two in step."""
+    return ("SELECT obsType, stat, reduction, value, usUnits, year "
+            f"FROM {table_name} "
+            "WHERE station_id = ? AND month = ? AND day = ?;")
+
+
+@functools.lru_cache(maxsize=None)
+def load_downloader(module_name):
+    """Import a downloader module. Stations usually share a downloader, so each is looked up
+    only once."""
+    return importlib.import_module(module_name)
+
+
+def open_climate_manager(config_dict, data_binding='climate_binding'):
+    """Open a manager for the climate database, creating the database if necessary."""
+    return weewx.manager.open_manager_with_config(config_dict,
+                                                  data_binding=data_binding,
+                                                  initialize=True,
+                                                  default_binding_dict=default_binding_dict)
+
+
+def apply_pragmas(connection):
+    """Apply the SQLite tuning pragmas to a weedb connection. Other databases are left alone."""
+    if connection.dbtype != 'sqlite':
         return
-    # Create the tables and indexes:
-    with weedb.connect(database_dict) as db_conn:
-        with weedb.Transaction(db_conn) as cursor:
-            cursor.execute(CREATE_CLIMATE_DATA % table_name)
-            cursor.execute(CREATE_CLIMATE_INDEX % table_name)
-            cursor.execute(CREATE_STATION_METADATA)
-        log.debug("Climate database table initialized.")
+    for pragma, value in SQLITE_PRAGMAS:
+        connection.execute(f"PRAGMA {pragma}={value};")
+
+
+@functools.lru_cache(maxsize=None)
+def schema_statements(table_name):
+    """Return the statements that create the climate tables and their indexes, formatted for a
+    given climate table. They are built, and the table name validated, only once per table."""
+    check_table_name(table_name)
+    return {
+        'tables': (CREATE_CLIMATE_DATA % table_name,
+                   CREATE_STATION_METADATA),
+        'indexes': (CREATE_CLIMATE_INDEX % (table_name, table_name),
+                    CREATE_CLIMATE_COVERING_INDEX % (table_name, table_name)),
+    }
+
+
+def setup_climate_database(connection, table_name):
+    """Create the climate tables, if they do not already exist."""
+    with weedb.Transaction(connection) as cursor:
+        for stmt in schema_statements(table_name)['tables']:
+            cursor.execute(stmt)
+
+
+def upgrade_climate_database(connection, table_name):
+    """Bring a climate database created by an earlier version up to date."""
+    if 'data_hash' not in connection.columnsOf('station_metadata'):
+        connection.execute("ALTER TABLE station_metadata ADD COLUMN data_hash TEXT;")
+        log.info("Added column 'data_hash' to the climate station metadata.")
+    # Earlier versions used a non-unique index on (station_id, month, day). The unique index
+    # starts with the same columns, so it replaces it.
+    for stmt in schema_statements(table_name)['indexes']:
+        connection.execute(stmt)
+    connection.execute(f"DROP INDEX IF EXISTS {table_name}_index;")
 
 
 if __name__ == "__main__":
@@ -23,6 +23,7 @@ $climate.day.outTemp.low.max      <-- Max low (high-low) temperature for this da
 
 import datetime
 import math
+import sys
 
 import weeutil.weeutil
 import weewx.units
@@ -34,8 +35,28 @@ from user.climate.climate import default_station_id
 
 weewx.units.obs_group_dict.setdefault('precip', 'group_rain')
 
+# The unit and unit group of the observation types that ACIS downloads, keyed by
+# (obs_type, us_units), for every unit system. Each Climate instance starts with a copy.
+_UNIT_CACHE_WARM = {
+    (obs_type, us_units): (std_group[weewx.units.obs_group_dict[obs_type]],
+                           weewx.units.obs_group_dict[obs_type])
+    for obs_type in ('outTemp', 'precip')
+    for us_units, std_group in weewx.units.std_groups.items()
+}
+
 earth_radius = TWxUtils.earthRadius45  # In km
 
+_NULL_VT = ValueTuple(None, None, None)
+
+# For the purposes of a database query, a reduction such as 'mintime' becomes 'min'. The names
+# are interned, to match the keys returned by StatsManager.get_normals().
+_DB_REDUCTIONS = {sys.intern(reduction): sys.intern(reduction.replace('time', ''))
+                  for reduction in ('min', 'max', 'avg', 'mintime', 'maxtime')}
+
+# Station metadata, keyed by (data_binding, station_id). It changes rarely, if ever, so it is
+# looked up only once, rather than on every report.
+_METADATA_CACHE = {}
+
 
 class Climate:
     def __init__(self,
@@ -73,37 +94,106 @@ class Climate:
             'data_binding': 'climate_binding',
         }
 
-        # Until we hit the metadata database, we don't know anything about the station.
-        self.name = self.location = self.latitude = self.longitude = self.altitude = None
-        # Get the metadata for the station.
-        self._get_metadata()
+        # The report time does not change, so neither does the day of the year it falls on.
+        report_d = datetime.date.fromtimestamp(report_time)
+        self._month, self._day = report_d.month, report_d.day
+
+        # All the statistics for a day, keyed by (data_binding, station_id, month, day). They
+        # are shared by all the tags that the templates evaluate.
+        self._day_cache = {}
+        # The unit and unit group of an observation type, keyed by (obs_type, us_units).
+        self._unit_cache = dict(_UNIT_CACHE_WARM)
+        # What a tag evaluates to when there is no data for it.
+        self._null_vh = None
+
+        # The station metadata. It is not looked up until a template asks for it.
+        self._meta = None
+        # The manager for the data binding. It is resolved when it is first needed.
+        self._db_manager = None
+
+    @classmethod
+    def invalidate_metadata_cache(cls):
+        """Forget all cached station metadata."""
+        _METADATA_CACHE.clear()
+
+    def _get_db_manager(self):
+        """Return the manager for the current data binding."""
+        if self._db_manager is None:
+            self._db_manager = self.params['db_lookup'](self.params['data_binding'])
+        return self._db_manager
+
+    def _ensure_meta(self):
+        """Look up the station metadata, if that has not been done already."""
+        if self._meta is None:
+            self._meta = self._get_metadata()
+        return self._meta
 
     def _get_metadata(self):
-        db_manager = self.params['db_lookup'](self.params['data_binding'])
-        results = db_manager.getSql("SELECT station_name, station_location, "
-                                    "latitude, longitude, altitude, altitude_unit "
-                                    "FROM station_metadata "
-                                    "WHERE station_id=?", (self.params['station_id'],))
-        if not results:
-            return
+        """Return a dictionary with the metadata for the station, formatted for the report. It
+        is empty if nothing is known about the station."""
+        key = (self.params['data_binding'], self.params['station_id'])
+        results = _METADATA_CACHE.get(key)
+        if results is None:
+            db_manager = self._get_db_manager()
+            results = db_manager.getSql("SELECT station_name, station_location, "
+                                        "latitude, longitude, altitude, altitude_unit "
+                                        "FROM station_metadata "
+                                        "WHERE station_id=?", (self.params['station_id'],))
+            if not results:
+                # Don't cache a miss. The station may not have been downloaded yet.
+                return {}
+            _METADATA_CACHE[key] = results
 
         # Unpack the results:
-        self.name, self.location, self.latitude_f, self.longitude_f, altitude, altitude_unit = results
+        name, location, latitude_f, longitude_f, altitude, altitude_unit = results
 
         # Add a bunch of formatted attributes:
         label_dict = self.params['skin_dict'].get('Labels', {})
         hemispheres = label_dict.get('hemispheres', ('N', 'S', 'E', 'W'))
         latlon_formats = label_dict.get('latlon_formats')
-        self.latitude = weeutil.weeutil.latlon_string(self.latitude_f,
+        return {
+            'name': name,
+            'location': location,
+            'latitude_f': latitude_f,
+            'longitude_f': longitude_f,
+            'latitude': weeutil.weeutil.latlon_string(latitude_f,
                                                       hemispheres[0:2],
-                                                      'lat', latlon_formats)
-        self.longitude = weeutil.weeutil.latlon_string(self.longitude_f,
+                                                      'lat', latlon_formats),
+            'longitude': weeutil.weeutil.latlon_string(longitude_f,
                                                        hemispheres[2:4],
-                                                       'lon', latlon_formats)
-
-        self.altitude = ValueHelper(value_t=ValueTuple(altitude, altitude_unit, 'group_altitude'),
+                                                       'lon', latlon_formats),
+            'altitude': ValueHelper(value_t=ValueTuple(altitude, altitude_unit, 'group_altitude'),
                                     formatter=self.params['formatter'],
-                                    converter=self.params['converter'])
+                                    converter=self.params['converter']),
+        }
+
+    @property
+    def name(self):
+        return self._ensure_meta().get('name')
+
+    @property
+    def location(self):
+        return self._ensure_meta().get('location')
+
+    @property
+    def latitude(self):
+        return self._ensure_meta().get('latitude')
+
+    @property
+    def longitude(self):
+        return self._ensure_meta().get('longitude')
+
+    @property
+    def altitude(self):
+        return self._ensure_meta().get('altitude')
+
+    @property
+    def latitude_f(self):
+        return self._ensure_meta().get('latitude_f')
+
+    @property
+    def longitude_f(self):
+        return self._ensure_meta().get('longitude_f')
 
     def __call__(self, station_id=None, data_binding=None):
         """Set a new station ID or data binding."""
@@ -111,15 +201,66 @@ class Climate:
             self.params['station_id'] = station_id
         if data_binding is not None:
             self.params['data_binding'] = data_binding
-        # Refresh metadata
-        self._get_metadata()
+            self._db_manager = None
+        # The metadata will be looked up again, when it is needed.
+        self._meta = None
         return self
 
     def station_id(self):
         return self.params['station_id']
 
     def __getattr__(self, period):
-        return ClimatePeriod(period, **self.params)
+        return _ClimateProxy(self, (period,))
+
+    def _lookup(self, period, obs_type, stat, reduction):
+        """Look up a climate statistic. Returns a ValueHelper."""
+        # For the purposes of a database query, a reduction such as 'mintime' becomes 'min'.
+        reduct = _DB_REDUCTIONS.get(reduction)
+        if reduct is None:
+            reduct = sys.intern(reduction.replace('time', ''))
+
+        # Hit the database, but only for the first tag evaluated for a day. That one query
+        # fetches the statistics for all the tags.
+        key = (self.params['data_binding'], self.params['station_id'], self._month, self._day)
+        normals = self._day_cache.get(key)
+        if normals is None:
+            db_manager = self._get_db_manager()
+            normals = db_manager.get_normals(self.params['station_id'], self._month, self._day)
+            self._day_cache[key] = normals
+        result = normals.get((obs_type, stat, reduct))
+
+        # Did we get a result?
+        if result:
+            # Yes. Create a ValueTuple from it:
+            value, us_units, year = result
+            if 'time' in reduction:
+                vt = ValueTuple(year, 'count', 'group_count')
+            else:
+                unit_key = (obs_type, us_units)
+                try:
+                    unit, g = self._unit_cache[unit_key]
+                except KeyError:
+                    # Figure out which group the observation type belongs to:
+                    g = weewx.units.obs_group_dict.get(obs_type)
+                    # Get the standard unit group for this unit system:
+                    std_group = weewx.units.std_groups[us_units]
+                    # Which unit the type is in:
+                    unit = std_group[g]
+                    self._unit_cache[unit_key] = unit, g
+                # Now we have what we need to create a ValueTuple:
+                vt = ValueTuple(value, unit, g)
+        else:
+            # No data. All misses can share the same ValueHelper.
+            if self._null_vh is None:
+                self._null_vh = ValueHelper(_NULL_VT,
+                                            formatter=self.params['formatter'],
+                                            converter=self.params['converter'])
+            return self._null_vh
+
+        vh = ValueHelper(vt,
+                         formatter=self.params['formatter'],
+                         converter=self.params['converter'])
+        return vh
 
     def distance(self):
         """Distance from the console station."""
@@ -139,90 +280,28 @@ class Climate:
                            converter=self.params['converter'])
 
 
-class ClimatePeriod:
-    def __init__(self, period, **params):
-        self.params = params
-        self.params['period'] = period
-
-    def __getattr__(self, obs_type):
-        return ClimateObsType(obs_type, **self.params)
-
-
-class ClimateObsType:
-    def __init__(self, obs_type, **params):
-        self.params = params
-        self.params['obs_type'] = obs_type
-
-    def __getattr__(self, stat):
-        return ClimateStat(stat, **self.params)
+class _ClimateProxy:
+    """Collects the parts of a tag such as $climate.day.outTemp.high.max, one attribute at a
+    time: the period, obs_type, stat, and reduction. Only when the tag is converted to a string
+    is the value looked up."""
+    __slots__ = ('_climate', '_path')
 
+    def __init__(self, climate, path):
+        self._climate = climate
+        self._path = path
 
-class ClimateStat:
-    def __init__(self, stat, **params):
-        """Incorporate a statistic. This is typically either 'high' or 'low'."""
-        self.params = params
-        self.params['stat'] = stat
-
-    def __getattr__(self, reduction):
-        return ClimateReduction(reduction, **self.params)
-
-
-class ClimateReduction:
-    def __init__(self, reduction, **params):
-        """Incorporate a reduction function. This is typically something like 'min', 'max',
-        'avg', 'mintime', etc."""
-        self.params = params
-        self.params['reduction'] = reduction
-
-    def _do_query(self):
-        # For the purposes of a database query, a reduction such as 'mintime' becomes 'min'.
-        reduct = self.params['reduction'].replace('time', '')
-        db_manager = self.params['db_lookup'](self.params['data_binding'])
-        # Form the SQL statement to be used:
-        stats_sql_stmt = ("SELECT value, usUnits, year FROM %s "
-                          "WHERE station_id = ? "
-                          "AND month = ? "
-                          "AND day = ? "
-                          "AND obsType = ? "
-                          "AND stat = ? "
-                          "AND reduction = ?;") % db_manager.table_name
-
-        report_d = datetime.date.fromtimestamp(self.params['report_time'])
-
-        # Hit the database:
-        result = db_manager.getSql(stats_sql_stmt, (self.params['station_id'],
-                                                    report_d.month,
-                                                    report_d.day,
-                                                    self.params['obs_type'],
-                                                    self.params['stat'],
-                                                    reduct))
-        # Did we get a result?
-        if result:
-            # Yes. Create a ValueTuple from it:
-            value, us_units, year = result
-            if 'time' in self.params['reduction']:
-                vt = ValueTuple(year, 'count', 'group_count')
-            else:
-                # Figure out which group the observation type belongs to:
-                g = weewx.units.obs_group_dict.get(self.params['obs_type'])
-                # Get the standard unit group for this unit system:
-                std_group = weewx.units.std_groups[us_units]
-                # Which unit the type is in:
-                unit = std_group[g]
-                # Now we have what we need to create a ValueTuple:
-                vt = ValueTuple(value, unit, g)
-        else:
-            vt = ValueTuple(None, None, None)
-
-        vh = ValueHelper(vt,
-                         formatter=self.params['formatter'],
-                         converter=self.params['converter'])
-        return vh
+    def __getattr__(self, name):
+        if len(self._path) >= 4 or name.startswith('__'):
+            raise AttributeError(name)
+        # Names arrive from Cheetah un-interned. Interning them lets the lookup of the
+        # statistic, whose keys are interned, be settled by comparing pointers.
+        return _ClimateProxy(self._climate, self._path + (sys.intern(name),))
 
     def __str__(self):
         """Need a string representation. Force the query, return as string."""
-        vh = self._do_query()
-        return str(vh)
+        if len(self._path) != 4:
+            return object.__str__(self)
+        return str(self._climate._lookup(*self._path))
 
 
 class ClimateSLE(SearchList):  # 1
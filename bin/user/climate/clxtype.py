@@ -4,59 +4,103 @@
 #    See the file LICENSE.txt for your full rights.
 #
 """Climate XType to support climate database aggregations"""
+import collections
 import datetime
+import functools
+import threading
 
 import weewx.xtypes
 from weewx.units import ValueTuple
 
 
+@functools.lru_cache(maxsize=None)
+def temperature_unit(us_units):
+    """Return the temperature unit used by a unit system."""
+    return weewx.units.std_groups[us_units]['group_temperature']
+
+
 class ClimateXType(weewx.xtypes.XType):
-    # The set of all valid aggregation types:
+    # All valid aggregation types. Each maps to the stat and reduction to look up, and whether
+    # the year of the statistic is wanted, rather than its value.
     climate_aggs = {
-        'high_avg', 'low_avg',
-        'high_high', 'high_high_year',
-        'low_high', 'low_high_year',
-        'low_low', 'low_low_year',
-        'high_low', 'high_low_year',
+        'high_avg': ('high', 'avg', False),
+        'low_avg': ('low', 'avg', False),
+        'high_high': ('high', 'max', False),
+        'high_high_year': ('high', 'max', True),
+        'low_high': ('low', 'max', False),
+        'low_high_year': ('low', 'max', True),
+        'low_low': ('low', 'min', False),
+        'low_low_year': ('low', 'min', True),
+        'high_low': ('high', 'min', False),
+        'high_low_year': ('high', 'min', True),
     }
-    stats_sql_stmt = (
-        "SELECT value, usUnits, year FROM %s "
-        "WHERE station_id = ? "
-        "AND month = ? AND day = ? "
-        "AND stat = ? AND reduction = ?;")
+
+    # How many days of statistics to keep in memory:
+    day_cache_size = 64
+
+    def __init__(self):
+        # The statistics for recently requested days, keyed by (database_name, table_name,
+        # station_id, month, day). Report generation reads it, while the download thread clears
+        # it, so it is guarded by a lock.
+        self._day_cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented whenever the cache is cleared.
+        self._generation = 0
+
+    def clear_cache(self):
+        """Forget all cached statistics. Call this after the climate database changes."""
+        with self._lock:
+            self._day_cache.clear()
+            self._generation += 1
+
+    def _get_normals(self, db_manager, station_id, month, day):
+        """Return all the statistics for a station and day, as StatsManager.get_normals()
+        would, but from the cache when possible."""
+        key = (db_manager.database_name, db_manager.table_name, station_id, month, day)
+        with self._lock:
+            normals = self._day_cache.get(key)
+            if normals is not None:
+                self._day_cache.move_to_end(key)
+                return normals
+            generation = self._generation
+
+        normals = db_manager.get_normals(station_id, month, day)
+
+        with self._lock:
+            # Do not cache the results if the database changed while they were being read.
+            if generation == self._generation:
+                self._day_cache[key] = normals
+                while len(self._day_cache) > ClimateXType.day_cache_size:
+                    self._day_cache.popitem(last=False)
+        return normals
 
     def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
 
         # Do we know how to calculate this kind of aggregation?
-        if aggregate_type not in ClimateXType.climate_aggs:
+        try:
+            stats, reduction, wants_year = ClimateXType.climate_aggs[aggregate_type]
+        except KeyError:
             raise weewx.UnknownAggregation(aggregate_type)
         # Are we aware of this observation type?
         if obs_type != 'outTemp':
             raise weewx.UnknownObservationType(obs_type)
 
-        from user.climate.climate import default_station_id
+        from user.climate.climate import default_station_id, StatsManager
+        # Only the climate database holds climate statistics.
+        if not isinstance(db_manager, StatsManager):
+            raise weewx.UnknownAggregation(aggregate_type)
         station_id = option_dict.get('station_id', default_station_id)
 
         # We determine which day to use by the start of the timespan:
         day = datetime.date.fromtimestamp(timespan.start)
 
-        # Figure out which stats and reduction to use:
-        stats, reduction = aggregate_type.split('_')[0:2]
-        if reduction == 'high':
-            reduction = 'max'
-        elif reduction == 'low':
-            reduction = 'min'
-
-        val = db_manager.getSql(ClimateXType.stats_sql_stmt % db_manager.table_name,
-                                (station_id, day.month, day.day, stats, reduction))
-        if val:
-            value, us_units, year = val
-        else:
-            value = us_units = year = None
-
-        if 'year' in aggregate_type:
+        normals = self._get_normals(db_manager, station_id, day.month, day.day)
+        value, us_units, year = normals.get((obs_type, stats, reduction), (None, None, None))
+
+        if wants_year:
             return ValueTuple(year, 'count', 'group_count')
 
-        std_group = weewx.units.std_groups[us_units]
-        unit = std_group['group_temperature']
-        return ValueTuple(value, unit, 'group_temperature')
+        # With no data, there is no unit system to take the unit from.
+        if us_units is None:
+            return ValueTuple(None, None, 'group_temperature')
+        return ValueTuple(value, temperature_unit(us_units), 'group_temperature')
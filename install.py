@@ -58,7 +58,7 @@ def loader():
 class ClimateInstaller(ExtensionInstaller):
     def __init__(self):
         super(ClimateInstaller, self).__init__(
-            version="1.3",
+            version="1.4",
             name='weewx-climate',
             description='Download climatological data from ACIS',
             author="Thomas Keffer",
@@ -70,7 +70,8 @@ class ClimateInstaller(ExtensionInstaller):
                     'bin/user/climate/__init__.py',
                     'bin/user/climate/acis.py',
                     'bin/user/climate/climate.py',
-                    'bin/user/climate/clsle.py'
+                    'bin/user/climate/clsle.py',
+                    'bin/user/climate/clxtype.py'
                 ]),
                 ('skins/Climate', [
                     'skins/Climate/index.html.tmpl',